@@ -0,0 +1,145 @@
+# Command line entry point for the crossmatch pipeline, run from this directory:
+#   python crossmatch.py index TobiasPitters/mmu-sdss-with-coordinates --output sdss_index.parquet
+#   python crossmatch.py match sdss_index.parquet hsc_index.parquet --left-name sdss --right-name hsc --output catalog.parquet
+#   python crossmatch.py materialize TobiasPitters/mmu-sdss-with-coordinates TobiasPitters/mmu-hsc-with-coordinates \
+#       --catalog catalog.parquet --left-name sdss --right-name hsc --output sdss_hsc/
+#   python crossmatch.py benchmark TobiasPitters/mmu-sdss-with-coordinates TobiasPitters/mmu-hsc-with-coordinates \
+#       --left-name sdss --right-name hsc --output sdss_hsc/
+# Only argparse is imported at startup, datasets and astropy are imported inside
+# the stage that needs them so --help and short jobs start quickly.
+import argparse
+import time
+
+DEFAULT_COLUMNS = ['ra', 'dec', 'healpix', 'object_id']
+
+
+def _load(path):
+    from datasets import load_dataset
+    # Parquet files written by the index stage, anything else goes through load_dataset
+    if path.endswith('.parquet'):
+        return load_dataset('parquet', data_files={'train': path})
+    return load_dataset(path)
+
+
+def _read_catalog(path):
+    from astropy.table import Table
+    return Table.read(path).group_by(['healpix'])
+
+
+def _write_catalog(catalog, path):
+    # SkyCoord columns are only needed for the matching itself
+    catalog.remove_columns([name for name in catalog.colnames if name.endswith('_sc')])
+    catalog.write(path, overwrite=True)
+
+
+def _match(args, left, right):
+    from functions.crossmatch_manual import cross_match_datasets_manual
+    return cross_match_datasets_manual(left,
+                                       right,
+                                       left_name=args.left_name,
+                                       right_name=args.right_name,
+                                       matching_radius=args.radius,
+                                       return_catalog_only=True,
+                                       coordinate_columns=args.columns)
+
+
+def _materialize(args, catalog, left, right):
+    from functions.arrow_shards import write_cross_matched_shards
+    return write_cross_matched_shards(catalog,
+                                      left,
+                                      right,
+                                      left_name=args.left_name,
+                                      right_name=args.right_name,
+                                      output_dir=args.output,
+                                      max_rows_per_shard=args.max_rows_per_shard,
+                                      num_proc=args.num_proc)
+
+
+def run_index(args):
+    ds = _load(args.dataset)['train']
+    ds.select_columns(args.columns).to_parquet(args.output)
+    print("Index written to: ", args.output)
+
+
+def run_match(args):
+    catalog = _match(args, _load(args.left), _load(args.right))
+    _write_catalog(catalog, args.output)
+    print("Catalog written to: ", args.output)
+
+
+def run_materialize(args):
+    matched = _materialize(args, _read_catalog(args.catalog), _load(args.left), _load(args.right))
+    print("Cross-matched dataset with", len(matched), "rows written to: ", args.output)
+
+
+def run_benchmark(args):
+    # Loading happens once and outside the timings, both stages share the datasets
+    left = _load(args.left)
+    right = _load(args.right)
+    start = time.perf_counter()
+    catalog = _match(args, left, right)
+    matched_at = time.perf_counter()
+    matched = _materialize(args, catalog, left, right)
+    materialized_at = time.perf_counter()
+    print(f"match:       {matched_at - start:.2f}s")
+    print(f"materialize: {materialized_at - matched_at:.2f}s ({len(matched)} rows)")
+    print(f"total:       {materialized_at - start:.2f}s")
+
+
+def _add_pair_arguments(parser):
+    parser.add_argument('left', help="left dataset, hub id, local path or index parquet file")
+    parser.add_argument('right', help="right dataset, hub id, local path or index parquet file")
+    parser.add_argument('--left-name', required=True)
+    parser.add_argument('--right-name', required=True)
+
+
+def _add_match_arguments(parser):
+    parser.add_argument('--radius', type=float, default=1., help="matching radius in arcsec")
+    parser.add_argument('--columns', nargs='+', default=DEFAULT_COLUMNS,
+                        help="columns used for matching, must include ra, dec, healpix and object_id")
+
+
+def _add_materialize_arguments(parser):
+    parser.add_argument('--max-rows-per-shard', type=int, default=None)
+    parser.add_argument('--num-proc', type=int, default=None)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='crossmatch', description="Cross-match MMU datasets.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index = subparsers.add_parser('index', help="write the coordinate columns of a dataset to parquet")
+    index.add_argument('dataset')
+    index.add_argument('--columns', nargs='+', default=DEFAULT_COLUMNS)
+    index.add_argument('--output', required=True, help="parquet file")
+    index.set_defaults(func=run_index)
+
+    match = subparsers.add_parser('match', help="cross-match two datasets and write the matched catalog")
+    _add_pair_arguments(match)
+    _add_match_arguments(match)
+    match.add_argument('--output', required=True, help="catalog file, format taken from the extension")
+    match.set_defaults(func=run_match)
+
+    materialize = subparsers.add_parser('materialize', help="write the matched rows as Arrow shards")
+    _add_pair_arguments(materialize)
+    _add_materialize_arguments(materialize)
+    materialize.add_argument('--catalog', required=True, help="catalog written by the match stage")
+    materialize.add_argument('--output', required=True, help="directory for the shards")
+    materialize.set_defaults(func=run_materialize)
+
+    benchmark = subparsers.add_parser('benchmark', help="time the match and materialize stages")
+    _add_pair_arguments(benchmark)
+    _add_match_arguments(benchmark)
+    _add_materialize_arguments(benchmark)
+    benchmark.add_argument('--output', required=True, help="directory for the shards")
+    benchmark.set_defaults(func=run_benchmark)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
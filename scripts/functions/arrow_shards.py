@@ -0,0 +1,192 @@
+from datasets import Dataset, DatasetInfo, concatenate_datasets
+from datasets.table import InMemoryTable
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, TYPE_CHECKING
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import tempfile
+import json
+import os
+
+# astropy is only needed for the annotations, the catalog is built by the caller
+if TYPE_CHECKING:
+    from astropy.table import Table
+
+MANIFEST_NAME = 'shards.json'
+
+
+def _row_indices(ds : Dataset, object_ids) -> np.ndarray:
+    # Look the catalog object ids up in the parent dataset's object_id column,
+    # done in Arrow so that no Python object is created per row
+    column = ds.with_format('arrow')['object_id']
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    ids = pa.array(np.asarray(object_ids)).cast(column.type)
+    rows = pc.index_in(ids, value_set=column)
+    assert rows.null_count == 0, "There was an error in the cross-matching."
+    return rows.to_numpy().astype(np.int64)
+
+
+def cross_matched_row_pairs(
+                         matched_catalog : "Table",
+                         left : Dataset,
+                         right : Dataset,
+                         left_name: str,
+                         right_name: str
+) -> List[Tuple[int, np.ndarray]]:
+    # One (healpix, pairs) entry per group of the matched catalog, pairs holds
+    # the (left row, right row) positions of every match in that group
+    pairs = np.stack([_row_indices(left, matched_catalog[f'{left_name}_object_id']),
+                      _row_indices(right, matched_catalog[f'{right_name}_object_id'])], axis=1)
+    indices = matched_catalog.groups.indices
+    return [(int(group['healpix'][0]), pairs[start:stop])
+            for group, start, stop in zip(matched_catalog.groups, indices[:-1], indices[1:])]
+
+
+def _replace_atomically(path : str, write):
+    # Write next to the final path and move it into place, a Dataset from an
+    # earlier run that still maps the old file keeps reading the old contents
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path),
+                                    suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def _arrow_source(ds : Dataset) -> Tuple[pa.Table, np.ndarray]:
+    # The backing Arrow table and, when the dataset was filtered or selected,
+    # the positions of its rows in that table
+    indices = None if ds._indices is None else ds._indices.column(0).to_numpy()
+    return ds.data.table, indices
+
+
+def _gather(source : Tuple[pa.Table, np.ndarray], rows : np.ndarray) -> pa.Table:
+    table, indices = source
+    if indices is not None:
+        rows = indices[rows]
+    return table.take(pa.array(rows))
+
+
+def _join_batches(pairs : np.ndarray, left, right, schema : pa.Schema, batch_size : int):
+    # Yields the joined rows of one shard, batch_size rows at a time, each
+    # gathered with a single take per side
+    for start in range(0, len(pairs), batch_size):
+        batch_pairs = pairs[start:start + batch_size]
+        left_table = _gather(left, batch_pairs[:, 0])
+        right_table = _gather(right, batch_pairs[:, 1])
+        # Horizontal concat, columns present in both datasets are taken from
+        # the right one, as dict.update did in the generator based version
+        columns = [right_table.column(name) if name in right_table.column_names
+                   else left_table.column(name) for name in schema.names]
+        yield pa.Table.from_arrays(columns, schema=schema).combine_chunks()
+
+
+def _write_shard(path : str, pairs : np.ndarray, left, right, schema : pa.Schema, batch_size : int):
+    def write(tmp_path):
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_stream(sink, schema) as writer:
+            for table in _join_batches(pairs, left, right, schema, batch_size):
+                writer.write_table(table, max_chunksize=batch_size)
+    return _replace_atomically(path, write)
+
+
+def _join_shard(pairs : np.ndarray, left, right, schema : pa.Schema, batch_size : int) -> pa.Table:
+    return pa.concat_tables(_join_batches(pairs, left, right, schema, batch_size))
+
+
+def _write_manifest(output_dir : str, paths : List[str]):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump([os.path.basename(path) for path in paths], f)
+    _replace_atomically(os.path.join(output_dir, MANIFEST_NAME), write)
+
+
+def _read_manifest(output_dir : str) -> List[str]:
+    with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+        return [os.path.join(output_dir, name) for name in json.load(f)]
+
+
+def write_cross_matched_shards(
+                         matched_catalog : "Table",
+                         left_ds : Dataset,
+                         right_ds : Dataset,
+                         left_name: str,
+                         right_name: str,
+                         output_dir : Optional[str],
+                         max_rows_per_shard : int = None,
+                         batch_size : int = 1000,
+                         num_proc : int = None,
+                         keep_in_memory : bool = False,
+                         reuse_existing : bool = False
+) -> Dataset:
+    if max_rows_per_shard is not None and max_rows_per_shard <= 0:
+        raise ValueError(f"max_rows_per_shard must be positive, got {max_rows_per_shard}")
+
+    # Rows are gathered from the backing Arrow tables, never decoded to Python
+    left = _arrow_source(left_ds['train'])
+    right = _arrow_source(right_ds['train'])
+
+    # Merging the features of both datasets
+    features = left_ds['train'].features.copy()
+    features.update(right_ds['train'].features)
+    # The schema carries the features as metadata, Dataset.from_file restores them from it
+    schema = features.arrow_schema
+
+    # Generating a description for the new dataset based on the two parent datasets
+    description = (f"Cross-matched dataset between {left_name} and {right_name}.")
+    info = DatasetInfo(description=description, features=features)
+
+    # One shard per healpix group, split further when it exceeds max_rows_per_shard
+    def plan_shards():
+        row_pairs = cross_matched_row_pairs(matched_catalog, left_ds['train'], right_ds['train'],
+                                            left_name, right_name)
+        for healpix, pairs in row_pairs:
+            step = max_rows_per_shard or max(len(pairs), 1)
+            for k, start in enumerate(range(0, len(pairs), step)):
+                yield f"{left_name}_{right_name}-healpix={healpix}-{k:05d}.arrow", pairs[start:start + step]
+
+    # Take, concatenation and IPC writes run in Arrow's C++ code without the GIL,
+    # so the worker threads below gather and write their shards in parallel
+
+    # Without an output directory the joined tables stay in memory, nothing is written
+    if output_dir is None:
+        with ThreadPoolExecutor(max_workers=num_proc or 1) as executor:
+            tables = list(executor.map(lambda shard: _join_shard(shard[1], left, right, schema, batch_size),
+                                       plan_shards()))
+        if not tables:
+            return Dataset.from_dict({name: [] for name in features}, features=features, info=info)
+        return Dataset(InMemoryTable(pa.concat_tables(tables)), info=info)
+
+    # The manifest is written last, so its presence means a complete earlier run
+    if reuse_existing and os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+        paths = _read_manifest(output_dir)
+        print("Reusing shards from: ", output_dir)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        # An interrupted rewrite must not leave the old manifest pointing at new shards
+        if os.path.exists(os.path.join(output_dir, MANIFEST_NAME)):
+            os.remove(os.path.join(output_dir, MANIFEST_NAME))
+        with ThreadPoolExecutor(max_workers=num_proc or 1) as executor:
+            paths = list(executor.map(lambda shard: _write_shard(os.path.join(output_dir, shard[0]), shard[1],
+                                                                 left, right, schema, batch_size),
+                                      plan_shards()))
+        print("Number of shards written: ", len(paths))
+
+        # Drop shards left over from an earlier run with a different split
+        prefix = f"{left_name}_{right_name}-healpix="
+        for name in os.listdir(output_dir):
+            path = os.path.join(output_dir, name)
+            if name.startswith(prefix) and name.endswith('.arrow') and path not in paths:
+                os.remove(path)
+        _write_manifest(output_dir, paths)
+
+    if not paths:
+        return Dataset.from_dict({name: [] for name in features}, features=features, info=info)
+    # Shards are memory mapped unless keep_in_memory is set
+    return concatenate_datasets([Dataset.from_file(path, info=info, in_memory=keep_in_memory)
+                                 for path in paths], info=info)
@@ -1,14 +1,15 @@
-from datasets import Dataset
-from typing import List
-from astropy.table import Table, hstack, vstack
-from astropy.coordinates import SkyCoord
-from astropy import units as u
-import numpy as np
+from typing import List, TYPE_CHECKING
+import os
+
+# datasets and astropy take seconds to import, they are only loaded once a
+# crossmatch actually runs so that importing this module stays cheap
+if TYPE_CHECKING:
+    from datasets import Dataset
 
 
 def cross_match_datasets_manual(
-                         left_ds : Dataset, 
-                         right_ds : Dataset,
+                         left_ds : "Dataset", 
+                         right_ds : "Dataset",
                          left_name: str,
                          right_name: str,
                          cache_dir : str = None,
@@ -16,8 +17,14 @@ def cross_match_datasets_manual(
                          matching_radius : float = 1., 
                          return_catalog_only : bool = False,
                          num_proc : int = None,
-                         coordinate_columns : List[str] = None
+                         coordinate_columns : List[str] = None,
+                         max_rows_per_shard : int = None
 ):
+    from astropy.table import Table, hstack
+    from astropy.coordinates import SkyCoord
+    from astropy import units as u
+    import numpy as np
+
     left = Table.from_pandas(left_ds['train'].to_pandas())
     right = Table.from_pandas(right_ds['train'].to_pandas())
     if coordinate_columns is not None:
@@ -63,35 +70,30 @@ def cross_match_datasets_manual(
     if return_catalog_only:
         return matched_catalog
 
-    catalog_groups = [group for group in matched_catalog.groups]
-    # Create a generator function that merges the two generators
-    def _generate_examples(groups):
-        for group in groups:
-            # can be used to filter the correct files, maybe we'll need a datasetbuilder either wway
-            healpix = group['healpix'][0]
-            # this is probably not easily streamable
-            left_ds_filtered = left_ds['train'].filter(lambda example: example['object_id'] in group[f'{left_name}_object_id'])
-            right_ds_filtered = right_ds['train'].filter(lambda example: example['object_id'] in group[f'{right_name}_object_id'])
-            for i, example_left in enumerate(left_ds_filtered):
-                right_obj_id = group[group[f'{left_name}_object_id'] == example_left['object_id']][f'{right_name}_object_id'][0]
-                example_right = right_ds_filtered.filter(lambda example: example['object_id'] == right_obj_id)[0]
-                assert str(group[i][left_name+'_object_id']) in example_left['object_id'], "There was an error in the cross-matching generation."
-                assert str(group[i][right_name+'_object_id']) in example_right['object_id'], "There was an error in the cross-matching generation."
-                example_left.update(example_right)
-                yield example_left
-    
-    # Merging the features of both datasets
-    features = left_ds['train'].features.copy()
-    features.update(right_ds['train'].features)
+    from datasets import config
+    from datasets.fingerprint import Hasher
+    from functions.arrow_shards import write_cross_matched_shards
 
-    # Generating a description for the new dataset based on the two parent datasets
-    description = (f"Cross-matched dataset between {left_name} and {right_name}.")
-    
-    # Create the new dataset
-    return Dataset.from_generator(_generate_examples,
-                                                   features,
-                                                   cache_dir=cache_dir,
-                                                   gen_kwargs={'groups':catalog_groups},
-                                                   num_proc=num_proc,
-                                                   keep_in_memory=keep_in_memory,
-                                                   description=description)
+    # Shards live in the datasets cache under a key derived from the inputs,
+    # a later call with the same key reuses them instead of writing again.
+    # keep_in_memory builds the dataset in memory and leaves no cache entry.
+    if keep_in_memory:
+        output_dir = None
+    else:
+        if cache_dir is None:
+            cache_dir = config.HF_DATASETS_CACHE
+        fingerprint = Hasher.hash([left_ds['train']._fingerprint, right_ds['train']._fingerprint,
+                                   left_name, right_name, matching_radius, coordinate_columns,
+                                   max_rows_per_shard])
+        output_dir = os.path.join(cache_dir, 'crossmatch', f"{left_name}_{right_name}-{fingerprint}")
+    # Write the joined columns straight into Arrow shards, one per healpix group,
+    # and memory map them back instead of encoding every example in Python
+    return write_cross_matched_shards(matched_catalog,
+                                      left_ds,
+                                      right_ds,
+                                      left_name=left_name,
+                                      right_name=right_name,
+                                      output_dir=output_dir,
+                                      max_rows_per_shard=max_rows_per_shard,
+                                      num_proc=num_proc,
+                                      reuse_existing=True)
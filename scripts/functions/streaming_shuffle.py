@@ -0,0 +1,133 @@
+from datasets import Dataset
+from functions.arrow_shards import cross_matched_row_pairs
+from typing import Dict, List, TYPE_CHECKING
+import numpy as np
+
+# astropy is only needed for the annotations, the catalog is built by the caller
+if TYPE_CHECKING:
+    from astropy.table import Table
+
+
+class ShuffledCrossMatchStream:
+    # Streams the crossmatch output in shuffled order with constant memory.
+    # Each shard holds the (left row, right row) pairs of one healpix group, the
+    # shard order is permuted per (seed, epoch) and the pairs are mixed through a
+    # buffer of at most buffer_size row pairs. The buffer and its RNG state are
+    # part of state_dict(), so a resumed stream yields exactly what an
+    # uninterrupted one would have.
+
+    def __init__(self, shards : List[np.ndarray], left : Dataset, right : Dataset,
+                 seed : int = 42, buffer_size : int = 1000, epoch : int = 0):
+        if buffer_size <= 0:
+            raise ValueError(f"buffer_size must be positive, got {buffer_size}")
+        self.shards = shards
+        self.left = left
+        self.right = right
+        self.seed = seed
+        self.buffer_size = buffer_size
+        self.epoch = epoch
+        self._pending_state = None
+        self._live_state = None
+
+    def set_epoch(self, epoch : int):
+        # The next iteration starts the given epoch from its beginning
+        self.epoch = epoch
+        self._pending_state = None
+        self._live_state = None
+
+    def _initial_state(self) -> Dict:
+        return {'epoch': self.epoch,
+                'shard_position': 0,
+                'example_position': 0,
+                'buffer': [],
+                'rng': np.random.default_rng([self.seed, self.epoch, 1]).bit_generator.state}
+
+    def state_dict(self) -> Dict:
+        # Position after the last yielded example. The buffer holds row pairs, not
+        # examples, so the checkpoint stays small and JSON serialisable.
+        if self._live_state is not None:
+            live = self._live_state
+            return {'epoch': live['epoch'],
+                    'shard_position': live['shard_position'],
+                    'example_position': live['example_position'],
+                    'buffer': [list(pair) for pair in live['buffer']],
+                    'rng': live['rng'].bit_generator.state}
+        if self._pending_state is not None:
+            return self._pending_state
+        return self._initial_state()
+
+    def load_state_dict(self, state_dict : Dict):
+        # The next iteration continues from the checkpoint
+        self.epoch = state_dict['epoch']
+        self._pending_state = state_dict
+        self._live_state = None
+
+    def _example(self, pair) -> Dict:
+        example = self.left[pair[0]]
+        example.update(self.right[pair[1]])
+        return example
+
+    def __iter__(self):
+        state = self._pending_state if self._pending_state is not None else self._initial_state()
+        self._pending_state = None
+
+        rng = np.random.default_rng()
+        rng.bit_generator.state = state['rng']
+        live = {'epoch': state['epoch'],
+                'shard_position': state['shard_position'],
+                'example_position': state['example_position'],
+                'buffer': [tuple(pair) for pair in state['buffer']],
+                'rng': rng}
+        self._live_state = live
+        buffer = live['buffer']
+
+        # The shard order only depends on (seed, epoch), so it is recomputed on resume
+        order = np.random.default_rng([self.seed, live['epoch']]).permutation(len(self.shards))
+        while live['shard_position'] < len(order):
+            pairs = self.shards[order[live['shard_position']]]
+            while live['example_position'] < len(pairs):
+                left_row, right_row = pairs[live['example_position']]
+                live['example_position'] += 1
+                if len(buffer) < self.buffer_size:
+                    buffer.append((int(left_row), int(right_row)))
+                    continue
+                i = rng.integers(len(buffer))
+                pair, buffer[i] = buffer[i], (int(left_row), int(right_row))
+                yield self._example(pair)
+            live['shard_position'] += 1
+            live['example_position'] = 0
+
+        # Drain the buffer in random order once every shard has been read
+        while buffer:
+            i = rng.integers(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            yield self._example(buffer.pop())
+
+
+def shuffle_cross_matched_catalog(
+                         matched_catalog : "Table",
+                         left_ds : Dataset,
+                         right_ds : Dataset,
+                         left_name: str,
+                         right_name: str,
+                         seed : int = 42,
+                         buffer_size : int = 1000,
+                         epoch : int = 0,
+                         state_dict : Dict = None
+) -> ShuffledCrossMatchStream:
+    # matched_catalog is the output of cross_match_datasets_manual(..., return_catalog_only=True)
+    left = left_ds['train']
+    right = right_ds['train']
+
+    # One shard per healpix group, stored as row indices, rows are only read
+    # from the parent datasets when an example leaves the buffer
+    shards = [pairs for _, pairs in cross_matched_row_pairs(matched_catalog, left, right,
+                                                            left_name, right_name)]
+    print("Number of healpix shards: ", len(shards))
+
+    stream = ShuffledCrossMatchStream(shards, left, right, seed=seed, buffer_size=buffer_size, epoch=epoch)
+    # Resume from a checkpoint taken with stream.state_dict(), including the
+    # buffered row pairs and the buffer RNG state
+    if state_dict is not None:
+        stream.load_state_dict(state_dict)
+    return stream
@@ -4,6 +4,8 @@
 # NOTE: 
 # this also runs with datasets==4 and numpy>1
 from datasets import load_dataset
+import pyarrow as pa
+import math
 from functions.crossmatch_manual import cross_match_datasets_manual
 
 
@@ -20,3 +22,10 @@ matched = cross_match_datasets_manual(sdss,
                                       )
 
 assert len(matched) == 25
+
+# Shards are written in record batches of up to 1000 rows, not one batch per row
+assert len(matched.cache_files) > 0
+for cache_file in matched.cache_files:
+    with pa.memory_map(cache_file['filename']) as source:
+        batches = list(pa.ipc.open_stream(source))
+    assert len(batches) == math.ceil(sum(len(batch) for batch in batches) / 1000)
@@ -0,0 +1,55 @@
+# Prerequisites:
+# uv pip install -r requirements.txt
+# ./download_sdss_hsc.sh
+from datasets import load_dataset
+from functions.crossmatch_manual import cross_match_datasets_manual
+from functions.streaming_shuffle import shuffle_cross_matched_catalog
+
+
+sdss = load_dataset("TobiasPitters/mmu-sdss-with-coordinates")
+hsc = load_dataset("TobiasPitters/mmu-hsc-with-coordinates")
+
+buffer_size = 8
+matched_catalog = cross_match_datasets_manual(sdss,
+                                              hsc,
+                                              left_name="sdss",
+                                              right_name="hsc",
+                                              matching_radius=1.0,
+                                              return_catalog_only=True,
+                                              coordinate_columns=['ra', 'dec', 'healpix', 'object_id']
+                                              )
+
+stream = shuffle_cross_matched_catalog(matched_catalog, sdss, hsc,
+                                       left_name="sdss",
+                                       right_name="hsc",
+                                       seed=42,
+                                       buffer_size=buffer_size)
+
+first_epoch = [example['object_id'] for example in stream]
+assert len(first_epoch) == 25
+
+# Same seed and epoch give the same order
+same_epoch = [example['object_id'] for example in stream]
+assert first_epoch == same_epoch
+
+# Checkpoint after a few examples and resume from there
+for i, example in enumerate(stream):
+    if i == 9:
+        checkpoint = stream.state_dict()
+        break
+resumed = shuffle_cross_matched_catalog(matched_catalog, sdss, hsc,
+                                        left_name="sdss",
+                                        right_name="hsc",
+                                        seed=42,
+                                        buffer_size=buffer_size,
+                                        state_dict=checkpoint)
+# The checkpoint carries the shuffle buffer and its RNG state, so the resumed
+# stream continues exactly where the uninterrupted one was
+resumed_ids = [example['object_id'] for example in resumed]
+assert resumed_ids == first_epoch[10:]
+
+# A new epoch reshuffles
+stream.set_epoch(1)
+second_epoch = [example['object_id'] for example in stream]
+assert sorted(first_epoch) == sorted(second_epoch)
+assert second_epoch != first_epoch